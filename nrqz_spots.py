@@ -1,15 +1,92 @@
 # from typing import Mapping, MutableMapping, Sequence, Iterable
 
-import json
-from typing import List
+import asyncio
+import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import lru_cache
+from operator import itemgetter
+from typing import AbstractSet, Dict, Iterator, List, Optional, Tuple
 from dataclasses import dataclass
 import requests as req
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from orjson import loads as _json_loads
+except ImportError:  # orjson is optional, then try simdjson
+    try:
+        from simdjson import loads as _json_loads
+    except ImportError:  # the standard library parses bytes too
+        from json import loads as _json_loads
+
+try:
+    import requests_cache
+except ImportError:  # requests-cache is optional, summits are then fetched every run
+    requests_cache = None
 
 SOTA_API_ROOT = "https://api2.sota.org.uk/"
 ASSOC_CHECK_LIST = ["W4V", "W7V"]
+REQUEST_TIMEOUT = (3.05, 10)  # (connect, read) seconds
+MAX_WORKERS = 16  # concurrent summit lookups
+SUMMIT_CACHE_NAME = "sota_rqz"  # in the user cache directory
+SUMMIT_CACHE_EXPIRY = timedelta(hours=6)
 
+# Fields of a spot or alert in Activation field order
+_SPOT_KEYS = itemgetter(
+    "associationCode", "summitCode", "timeStamp", "frequency", "activatorCallsign"
+)
+_ALERT_KEYS = itemgetter(
+    "associationCode", "summitCode", "timeStamp", "frequency", "activatingCallsign"
+)
 
-@dataclass
+
+def _make_session(cache_summits: bool) -> req.Session:
+    """Make a session for the SOTA API
+
+    Args:
+        cache_summits (bool): cache summit details on disk between runs; the spot
+            and alert lists are always fetched afresh
+
+    Returns:
+        req.Session: the session
+    """
+    if cache_summits:
+        session = requests_cache.CachedSession(
+            SUMMIT_CACHE_NAME,
+            backend="sqlite",
+            use_cache_dir=True,
+            expire_after=SUMMIT_CACHE_EXPIRY,
+            allowable_methods=("GET",),
+            cache_control=True,
+            urls_expire_after={
+                "*/api/spots/*": requests_cache.DO_NOT_CACHE,
+                "*/api/alerts": requests_cache.DO_NOT_CACHE,
+            },
+        )
+    else:
+        session = req.Session()
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=2 * MAX_WORKERS,  # restricted queries may run together
+            max_retries=Retry(total=3, backoff_factor=0.2),
+        ),
+    )
+    session.headers.update({"User-Agent": "sota-rqz/1.0"})
+    return session
+
+
+# A single session shares pooled keep-alive connections across all API calls
+_SESSION = _make_session(cache_summits=False)
+
+# Conditional request headers and the parsed body of the last response, by URL
+_etag_cache: Dict[str, Tuple[Dict[str, str], list]] = {}
+
+
+@dataclass(slots=True, frozen=True)
 class Activation:
     association: str
     summit: str
@@ -18,7 +95,107 @@ class Activation:
     activator: str
 
     def __str__(self) -> str:
-        return f'{self.association}/{self.summit} "{get_name(self.association, self.summit)}" at {self.date_time}, frequencies "{self.frequencies}" by {self.activator}'
+        return self.describe(get_name(self.association, self.summit))
+
+    def describe(self, name: str) -> str:
+        """Describe the activation using an already known summit name
+
+        Args:
+            name (str): the name of the summit
+
+        Returns:
+            str: the description of the activation
+        """
+        return f'{self.association}/{self.summit} "{name}" at {self.date_time}, frequencies "{self.frequencies}" by {self.activator}'
+
+
+def _fetch_summit_info(assoc: str, summit: str) -> dict:
+    """Get the details of a summit
+
+    Args:
+        assoc (str): the association code
+        summit (str): the summit code
+
+    Raises:
+        requests.HTTPError: if the details could not be fetched
+
+    Returns:
+        dict: the summit details
+    """
+    resp = _SESSION.get(
+        f"{SOTA_API_ROOT}api/summits/{assoc}/{summit}", timeout=REQUEST_TIMEOUT
+    )
+
+    if resp.status_code != 200:
+        raise req.HTTPError(
+            f"{resp.status_code} fetching summit {assoc}/{summit}", response=resp
+        )
+
+    return _json_loads(resp.content)
+
+
+@lru_cache(maxsize=4096)
+def _summit_meta(assoc: str, summit: str) -> Tuple[str, bool]:
+    """Get the name of a summit and whether it has restrictions, caching the result
+
+    Failed lookups raise rather than return, so they are not cached.
+
+    Args:
+        assoc (str): the association code
+        summit (str): the summit code
+
+    Raises:
+        requests.HTTPError: if the details could not be fetched
+
+    Returns:
+        Tuple[str, bool]: the summit name and True if the summit has any restrictions
+    """
+    summit_info = _fetch_summit_info(assoc, summit)
+    return summit_info["name"], len(summit_info["restrictionList"]) > 0
+
+
+def _lookup_summit(assoc: str, summit: str) -> Optional[Tuple[str, bool]]:
+    """Get the name of a summit and whether it has restrictions, if available
+
+    Args:
+        assoc (str): the association code
+        summit (str): the summit code
+
+    Returns:
+        Optional[Tuple[str, bool]]: the summit name and True if the summit has any
+        restrictions, or None if they could not be fetched
+    """
+    try:
+        return _summit_meta(assoc, summit)
+    except req.HTTPError:
+        return None
+
+
+def clear_summit_cache() -> None:
+    """Forget cached summit details, e.g. in a long-running process"""
+    _summit_meta.cache_clear()
+
+
+def enable_summit_cache() -> bool:
+    """Cache summit details on disk between runs, if requests-cache is installed
+
+    Summit details rarely change, so repeated runs (e.g. from cron) can reuse
+    them. The cache lives in the user cache directory; if that cannot be
+    written, the plain session is kept.
+
+    Returns:
+        bool: True if the on-disk cache is in use
+    """
+    global _SESSION
+    if requests_cache is None:
+        return False
+
+    if not isinstance(_SESSION, requests_cache.CachedSession):
+        try:
+            _SESSION = _make_session(cache_summits=True)
+        except (OSError, sqlite3.Error):
+            return False
+    return True
 
 
 def get_name(assoc: str, summit: str) -> str:
@@ -31,11 +208,9 @@ def get_name(assoc: str, summit: str) -> str:
     Returns:
         str: the name of the summit
     """
-    resp = req.get(f"{SOTA_API_ROOT}api/summits/{assoc}/{summit}")
-
-    if resp.status_code == 200:
-        summit_info = json.loads(resp.text)
-        return summit_info["name"]
+    meta = _lookup_summit(assoc, summit)
+    if meta is not None:
+        return meta[0]
 
     return ""
 
@@ -51,44 +226,134 @@ def is_restricted(activation: Activation, check_assocs: List[str]) -> bool:
         bool: True if the summit has any restrictions
     """
     if activation.association in check_assocs:
-        resp = req.get(
-            f"{SOTA_API_ROOT}api/summits/{activation.association}/{activation.summit}"
-        )
-
-        if resp.status_code == 200:
-            summit_info = json.loads(resp.text)
-            return len(summit_info["restrictionList"]) > 0
+        meta = _lookup_summit(activation.association, activation.summit)
+        if meta is not None:
+            return meta[1]
 
     return False
 
 
-def get_spots(hours: int) -> List[Activation]:
-    """Get a list of SOTA spots
+def _lookup_summits(
+    candidates: List[Activation],
+) -> Dict[Tuple[str, str], Optional[Tuple[str, bool]]]:
+    """Look up the summits of some activations
+
+    The summit lookups are independent, so they are made concurrently on
+    worker threads sharing the pooled session.
 
     Args:
-        hours (int): restrict the list to this age in hours
+        candidates (List[Activation]): the activations whose summits to look up
 
     Returns:
-        List[Activation]: the list of spots as Activation objects
+        Dict[Tuple[str, str], Optional[Tuple[str, bool]]]: the summit name and
+        whether it has any restrictions, or None if they could not be fetched,
+        by (association code, summit code)
+    """
+    # Several activations often share a summit, so look each one up only once
+    summits = list(dict.fromkeys((a.association, a.summit) for a in candidates))
+    if not summits:
+        return {}
+
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    try:
+        metas = list(executor.map(lambda s: _lookup_summit(*s), summits))
+    except BaseException:
+        # Don't wait for the remaining lookups when one of them has failed
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
+    return dict(zip(summits, metas))
+
+
+def _describe_restricted(
+    candidates: List[Activation],
+    summit_metas: Dict[Tuple[str, str], Optional[Tuple[str, bool]]],
+) -> List[str]:
+    """Describe the activations of summits for which there are restrictions
+
+    Args:
+        candidates (List[Activation]): the activations to check, already limited
+            to the associations of interest
+        summit_metas (Dict[Tuple[str, str], Optional[Tuple[str, bool]]]): the
+            looked up summits of the candidates
+
+    Returns:
+        List[str]: descriptions of the activations of restricted summits
+    """
+    results = []
+    for activation in candidates:
+        meta = summit_metas[(activation.association, activation.summit)]
+        if meta is not None and meta[1]:
+            results.append(activation.describe(meta[0]))
+    return results
+
+
+def _get_list(url: str) -> list:
+    """Get a JSON list from the SOTA API, reusing the last copy if unchanged
+
+    The ETag and Last-Modified headers of each response are replayed on the
+    next request for the same URL, so the server can answer 304 Not Modified.
+
+    Args:
+        url (str): the URL of the list
+
+    Returns:
+        list: the parsed list, or an empty list if it could not be fetched
     """
-    resp = req.get(f"{SOTA_API_ROOT}api/spots/-{hours}/all")
+    cached = _etag_cache.get(url)
+    resp = _SESSION.get(
+        url, headers=cached[0] if cached else None, timeout=REQUEST_TIMEOUT
+    )
+
+    if resp.status_code == 304 and cached is not None:
+        return cached[1]
 
     if resp.status_code == 200:
-        spots = json.loads(resp.text)
-        return [
-            Activation(
-                spot["associationCode"],
-                spot["summitCode"],
-                spot["timeStamp"],
-                spot["frequency"],
-                spot["activatorCallsign"],
-            )
-            for spot in spots
-        ]
+        items = _json_loads(resp.content)
+        validators = {}
+        if "ETag" in resp.headers:
+            validators["If-None-Match"] = resp.headers["ETag"]
+        if "Last-Modified" in resp.headers:
+            validators["If-Modified-Since"] = resp.headers["Last-Modified"]
+        if validators:
+            _etag_cache[url] = (validators, items)
+        else:
+            _etag_cache.pop(url, None)
+        return items
 
     return []
 
 
+def _iter_spots(
+    hours: int, filter_set: Optional[AbstractSet[str]] = None
+) -> Iterator[Activation]:
+    """Generate SOTA spots
+
+    Args:
+        hours (int): restrict the spots to this age in hours
+        filter_set (Optional[AbstractSet[str]]): if given, only generate spots
+            for these association codes
+
+    Yields:
+        Activation: each spot as an Activation object
+    """
+    for spot in _get_list(f"{SOTA_API_ROOT}api/spots/-{hours}/all"):
+        if filter_set is None or spot["associationCode"] in filter_set:
+            yield Activation(*_SPOT_KEYS(spot))
+
+
+def get_spots(hours: int) -> List[Activation]:
+    """Get a list of SOTA spots
+
+    Args:
+        hours (int): restrict the list to this age in hours
+
+    Returns:
+        List[Activation]: the list of spots as Activation objects
+    """
+    return list(_iter_spots(hours))
+
+
 def get_restricted_spots(hours: int, check_assocs: List[str]) -> List[str]:
     """Get a list of SOTA spots for which there are restrictions
 
@@ -99,10 +364,23 @@ def get_restricted_spots(hours: int, check_assocs: List[str]) -> List[str]:
     Returns:
         List[Activation]: the list of spots for restricted summits as Activation objects
     """
-    spots = get_spots(hours)
+    candidates = list(_iter_spots(hours, frozenset(check_assocs)))
+    return _describe_restricted(candidates, _lookup_summits(candidates))
+
 
-    restricted = filter(lambda spot: is_restricted(spot, check_assocs), spots)
-    return [str(spot) for spot in restricted]
+def _iter_alerts(filter_set: Optional[AbstractSet[str]] = None) -> Iterator[Activation]:
+    """Generate SOTA alerts
+
+    Args:
+        filter_set (Optional[AbstractSet[str]]): if given, only generate alerts
+            for these association codes
+
+    Yields:
+        Activation: each alert as an Activation object
+    """
+    for alert in _get_list(f"{SOTA_API_ROOT}api/alerts"):
+        if filter_set is None or alert["associationCode"] in filter_set:
+            yield Activation(*_ALERT_KEYS(alert))
 
 
 def get_alerts() -> List[Activation]:
@@ -111,22 +389,7 @@ def get_alerts() -> List[Activation]:
     Returns:
         List[Activation]: the lists of alerts, as Activatiom objects
     """
-    resp = req.get(f"{SOTA_API_ROOT}api/alerts")
-
-    if resp.status_code == 200:
-        alerts = json.loads(resp.text)
-        return [
-            Activation(
-                alert["associationCode"],
-                alert["summitCode"],
-                alert["timeStamp"],
-                alert["frequency"],
-                alert["activatingCallsign"],
-            )
-            for alert in alerts
-        ]
-
-    return []
+    return list(_iter_alerts())
 
 
 def get_restricted_alerts(check_assocs: List[str]) -> List[str]:
@@ -138,26 +401,37 @@ def get_restricted_alerts(check_assocs: List[str]) -> List[str]:
     Returns:
         List[Activation]: the lists of alerts for restricted summits, as Activatiom objects
     """
-    alerts = get_alerts()
-
-    restricted = filter(lambda alert: is_restricted(alert, check_assocs), alerts)
-    return [str(alert) for alert in restricted]
+    candidates = list(_iter_alerts(frozenset(check_assocs)))
+    return _describe_restricted(candidates, _lookup_summits(candidates))
 
 
-if __name__ == "__main__":
+async def _main() -> None:
     """Print any spots in the last hour and any alerts for which there are restrictions."""
+    enable_summit_cache()
+    check_set = frozenset(ASSOC_CHECK_LIST)
+    spot_candidates, alert_candidates = await asyncio.gather(
+        asyncio.to_thread(list, _iter_spots(1, check_set)),
+        asyncio.to_thread(list, _iter_alerts(check_set)),
+    )
+    # Alerted summits are often spotted too, so look up the union only once
+    summit_metas = await asyncio.to_thread(
+        _lookup_summits, spot_candidates + alert_candidates
+    )
+    spots = _describe_restricted(spot_candidates, summit_metas)
+    alerts = _describe_restricted(alert_candidates, summit_metas)
+
     print("List of restricted spots in last hour:")
-    spots = get_restricted_spots(1, ASSOC_CHECK_LIST)
     if len(spots) == 0:
         print("None")
     else:
-        for spot in spots:
-            print(spot)
+        sys.stdout.write("\n".join(spots) + "\n")
     print()
     print("List of restricted alerts:")
-    alerts = get_restricted_alerts(ASSOC_CHECK_LIST)
     if len(alerts) == 0:
         print("None")
     else:
-        for alert in alerts:
-            print(alert)
+        sys.stdout.write("\n".join(alerts) + "\n")
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())